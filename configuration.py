@@ -1,6 +1,7 @@
 # This file is part product_variant module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from trytond.cache import Cache
 from trytond.model import fields
 from trytond.pool import PoolMeta
 
@@ -12,3 +13,32 @@ class Configuration:
     __name__ = 'product.configuration'
     unique_variant = fields.Boolean('Unique variant', help='Default value'
         ' for the unique variant field in template form.')
+    _unique_variant_cache = Cache('product_configuration.unique_variant',
+        context=False)
+
+    @classmethod
+    def get_unique_variant(cls):
+        'Return the unique variant default value of the templates'
+        value = cls._unique_variant_cache.get('unique_variant', -1)
+        if value != -1:
+            return value
+        config = cls.get_singleton()
+        value = config.unique_variant if config else None
+        cls._unique_variant_cache.set('unique_variant', value)
+        return value
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(Configuration, cls).create(vlist)
+        cls._unique_variant_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super(Configuration, cls).write(*args)
+        cls._unique_variant_cache.clear()
+
+    @classmethod
+    def delete(cls, records):
+        super(Configuration, cls).delete(records)
+        cls._unique_variant_cache.clear()
@@ -0,0 +1,159 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import csv
+import logging
+import time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['read_rows', 'import_rows', 'import_csv']
+
+logger = logging.getLogger(__name__)
+
+
+def read_rows(csv_file, delimiter=',', encoding='utf-8'):
+    '''
+    Yield the line number and the values dictionary of each row of the CSV
+    file
+    '''
+    reader = csv.DictReader(csv_file, delimiter=delimiter)
+    for row in reader:
+        values = {}
+        for key, value in row.iteritems():
+            if key is None:
+                # The cells beyond the header are listed under restkey
+                values[key] = value
+                continue
+            if isinstance(key, str):
+                key = key.decode(encoding)
+            if isinstance(value, str):
+                value = value.decode(encoding)
+            values[key] = value.strip() if value else value
+        yield reader.line_num, values
+
+
+def import_rows(rows, batch_size=1000, commit=True):
+    '''
+    Create a unique variant template with its product for each (line, row)
+    with the keys name, code, list_price, cost_price, default_uom and type.
+    The rows are created by batches and each batch is committed. When a
+    batch is rejected, its rows are created one by one to report the error
+    of each line, without commit the error is raised.
+    Return the number of created templates and the list of (line, error).
+    '''
+    pool = Pool()
+    Product = pool.get('product.product')
+    Uom = pool.get('product.uom')
+
+    uoms = {}
+    for uom in Uom.search([]):
+        uoms.setdefault(uom.symbol, uom.id)
+        uoms.setdefault(uom.name, uom.id)
+
+    created = 0
+    errors = []
+    start = time.time()
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+
+        codes = set(r.get('code') for _, r in batch if r.get('code'))
+        with Transaction().set_context(active_test=False):
+            existing_codes = set(p.code for p in Product.search([
+                        ('code', 'in', list(codes)),
+                        ]))
+        vlist = []
+        lines = []
+        for line, row in batch:
+            try:
+                values = _template_values(row, uoms)
+            except ValueError as exception:
+                errors.append((line, exception.args[0]))
+                continue
+            code = row.get('code')
+            if code:
+                if code in existing_codes:
+                    errors.append((line, 'Code "%s" already exists' % code))
+                    continue
+                existing_codes.add(code)
+            vlist.append(values)
+            lines.append(line)
+        if vlist:
+            created += _create_templates(vlist, lines, errors, commit)
+        if commit:
+            Transaction().cursor.commit()
+        logger.info('%s templates created, %s errors, %.1f rows/s', created,
+            len(errors),
+            (created + len(errors)) / max(time.time() - start, 1e-6))
+    errors.sort()
+    return created, errors
+
+
+def import_csv(csv_file, batch_size=1000, commit=True, delimiter=',',
+        encoding='utf-8'):
+    'Import the unique variant templates of the CSV file'
+    return import_rows(read_rows(csv_file, delimiter=delimiter,
+            encoding=encoding), batch_size=batch_size, commit=commit)
+
+
+def _create_templates(vlist, lines, errors, commit):
+    '''
+    Create the templates of vlist and return their number. If the ORM
+    rejects them, they are created one by one and the error of each line is
+    appended to errors.
+    '''
+    pool = Pool()
+    Template = pool.get('product.template')
+    cursor = Transaction().cursor
+
+    try:
+        Template.create(vlist)
+        return len(vlist)
+    except UserError:
+        if not commit:
+            raise
+        cursor.rollback()
+
+    created = 0
+    for line, values in zip(lines, vlist):
+        try:
+            Template.create([values])
+        except UserError as exception:
+            cursor.rollback()
+            errors.append((line, exception.message))
+        else:
+            cursor.commit()
+            created += 1
+    return created
+
+
+def _template_values(row, uoms):
+    if None in row:
+        raise ValueError('Too many columns')
+    if not row.get('name'):
+        raise ValueError('Missing name')
+    uom = row.get('default_uom')
+    if uom not in uoms:
+        raise ValueError('Unknown unit of measure "%s"' % uom)
+    values = {
+        'name': row['name'],
+        'unique_variant': True,
+        'default_uom': uoms[uom],
+        'products': [('create', [{
+                        'code': row.get('code') or None,
+                        }])],
+        }
+    if row.get('type'):
+        values['type'] = row['type']
+    for field in ('list_price', 'cost_price'):
+        try:
+            values[field] = Decimal(row.get(field) or 0)
+        except InvalidOperation:
+            raise ValueError('Wrong %s "%s"' % (field, row[field]))
+    return values
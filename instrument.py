@@ -0,0 +1,117 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import time
+import weakref
+from functools import wraps
+from threading import Lock, local
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['instrumented', 'enabled', 'counters', 'transaction_counters',
+    'reset']
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_KEY = 'product_variant_unique_instrument'
+
+_lock = Lock()
+_counters = {}
+_transactions = weakref.WeakKeyDictionary()
+_local = local()
+
+
+def enabled():
+    '''
+    Return True if the instrumentation is activated by the context key or by
+    the instrument option of the product_variant_unique section of the
+    configuration file
+    '''
+    if Transaction().context.get(CONTEXT_KEY):
+        return True
+    return config.getboolean('product_variant_unique', 'instrument',
+        default=False)
+
+
+def _add(counters, name, queries, seconds):
+    values = counters.setdefault(name, {
+            'calls': 0,
+            'queries': 0,
+            'seconds': 0.,
+            })
+    values['calls'] += 1
+    values['queries'] += queries
+    values['seconds'] += seconds
+
+
+def _format(counters):
+    return ', '.join('%s: %s calls %s queries %.3fs' % (name,
+            values['calls'], values['queries'], values['seconds'])
+        for name, values in sorted(counters.iteritems()))
+
+
+def _call(name, func, args, kwargs):
+    cursor = Transaction().cursor
+    outermost = not getattr(_local, 'depth', 0)
+    if outermost:
+        _local.depth = 0
+        _local.queries = 0
+        execute = cursor.execute
+
+        def counted_execute(*args, **kwargs):
+            _local.queries += 1
+            return execute(*args, **kwargs)
+        cursor.execute = counted_execute
+    _local.depth += 1
+    queries = _local.queries
+    start = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        seconds = time.time() - start
+        queries = _local.queries - queries
+        _local.depth -= 1
+        if outermost:
+            del cursor.execute
+        with _lock:
+            _add(_counters, name, queries, seconds)
+            transaction = _transactions.setdefault(cursor, {})
+            _add(transaction, name, queries, seconds)
+            if outermost and logger.isEnabledFor(logging.DEBUG):
+                logger.debug('transaction %s: %s', id(cursor),
+                    _format(transaction))
+
+
+def instrumented(name):
+    '''
+    Decorate the method to record under name its calls, SQL statements and
+    time when the instrumentation is enabled
+    '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            return _call(name, func, args, kwargs)
+        return wrapper
+    return decorator
+
+
+def counters():
+    'Return the counters of the process by method name'
+    with _lock:
+        return dict((k, v.copy()) for k, v in _counters.iteritems())
+
+
+def transaction_counters():
+    'Return the counters of the current transaction by method name'
+    with _lock:
+        transaction = _transactions.get(Transaction().cursor, {})
+        return dict((k, v.copy()) for k, v in transaction.iteritems())
+
+
+def reset():
+    'Reset the counters of the process'
+    with _lock:
+        _counters.clear()
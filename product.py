@@ -1,16 +1,113 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import datetime
+import logging
+import sys
+import time
+from collections import defaultdict
+from decimal import Decimal
+from itertools import chain
+
+from sql import For, Null, Union
+from sql.aggregate import Count
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.exceptions import UserError
 from trytond.const import OPERATORS
 from trytond.model import fields
+from trytond.model.modelsql import convert_from
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import If, Or, Eval
+from trytond.pyson import If, Or, Eval, Date, PYSONEncoder
 from trytond.transaction import Transaction
+from trytond.wizard import StateAction
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.modules.product.product import STATES, DEPENDS
 
+from .instrument import instrumented
+
 __all__ = ['Template', 'Product', 'ProductByLocation',
     'OpenProductQuantitiesByWarehouse']
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger(__name__)
+
+
+def stored_code():
+    '''
+    Return True if the code of the unique variant templates is stored in the
+    template table, which is set by the stored_code option of the
+    product_variant_unique section of the configuration file.
+    '''
+    return config.getboolean('product_variant_unique', 'stored_code',
+        default=False)
+
+
+def clear_cache(Model, ids):
+    'Clear the record caches of the ids of Model updated with SQL'
+    transaction = Transaction()
+    transaction.counter += 1
+    for cache in transaction.cursor.cache.itervalues():
+        if Model.__name__ in cache:
+            for id_ in ids:
+                if id_ in cache[Model.__name__]:
+                    cache[Model.__name__][id_].clear()
+
+
+def find_active_code(domain):
+    '''
+    Return if the domain contains a clause on inactive records and a clause
+    on code or rec_name
+    '''
+    active_found = code_found = False
+    for arg in domain:
+        if (isinstance(arg, (tuple, list)) and len(arg) == 3
+                and (tuple(arg) == ('active', '=', False)
+                    or (arg[0] == 'active' and arg[1] == 'in'
+                        and False in arg[2]))):
+            active_found = True
+        elif (isinstance(arg, tuple)
+                or (isinstance(arg, list)
+                    and len(arg) > 2
+                    and arg[1] in OPERATORS)):
+            if arg[0] in ('code', 'rec_name'):
+                code_found = True
+        elif isinstance(arg, list):
+            active_found_rec, code_found_rec = find_active_code(arg)
+            active_found |= active_found_rec
+            code_found |= code_found_rec
+        if active_found and code_found:
+            break
+    return active_found, code_found
+
+
+def prefix_range(operator, value):
+    '''
+    Return the clauses of the range of the codes matched by the prefix pattern
+    or an empty list. Only the prefixes without cased characters are
+    converted to be independent of the case sensitivity of the backend.
+    '''
+    if (operator not in ('like', 'ilike')
+            or not isinstance(value, basestring)
+            or not value.endswith('%')):
+        return []
+    prefix = value[:-1]
+    if isinstance(prefix, str):
+        prefix = prefix.decode('utf-8')
+    if (not prefix or any(c in prefix for c in '%_\\')
+            or prefix.lower() != prefix.upper()):
+        return []
+    last = ord(prefix[-1])
+    if last >= sys.maxunicode:
+        return []
+    return [
+        ('>=', prefix),
+        ('<', prefix[:-1] + unichr(last + 1)),
+        ]
+
+
 UNIQUE_STATES = STATES.copy()
 UNIQUE_STATES.update({
         'invisible': ~Eval('unique_variant', False)
@@ -19,28 +116,70 @@ UNIQUE_STATES.update({
 
 class Template:
     __name__ = 'product.template'
+    _code_cache = Cache('product_template.code', context=False,
+        size_limit=config.getint('product_variant_unique', 'code_cache',
+            default=10240))
 
     unique_variant = fields.Boolean('Unique variant')
     code = fields.Function(fields.Char("Code", states=UNIQUE_STATES,
             depends=DEPENDS + ['unique_variant']),
         'get_code', setter='set_code', searcher='search_code')
+    stored_code = fields.Char('Stored Code', readonly=True, select=True)
 
     @classmethod
     def __setup__(cls):
         super(Template, cls).__setup__()
         cls.products.size = If(Eval('unique_variant', False), 1, 9999999)
+        # The stock fields are summed for all the templates at once
+        for fname in ('quantity', 'forecast_quantity', 'cost_value'):
+            field = getattr(cls, fname, None)
+            if field and field.getter == 'sum_product':
+                field.getter = 'get_product_sum'
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Product = pool.get('product.product')
+        table = cls.__table__()
+        product = Product.__table__()
+        cursor = Transaction().cursor
+
+        super(Template, cls).__register__(module_name)
+
+        if stored_code():
+            # The column is not synchronized while the option is off, so
+            # copy the codes which are missing or outdated
+            cursor.execute(*table.join(product, 'LEFT',
+                    condition=product.template == table.id
+                    ).select(table.id,
+                    where=table.unique_variant
+                    & (((table.stored_code == Null) & (product.code != Null))
+                        | ((table.stored_code != Null)
+                            & (product.code == Null))
+                        | (table.stored_code != product.code))))
+            ids = [i for i, in cursor.fetchall()]
+            if ids:
+                cls.update_stored_code(cls.browse(ids))
 
     @staticmethod
     def default_unique_variant():
         pool = Pool()
         Config = pool.get('product.configuration')
-        config = Config.get_singleton()
-        if config:
-            return config.unique_variant
+        return Config.get_unique_variant()
 
     @classmethod
     def search_rec_name(cls, name, clause):
         domain = super(Template, cls).search_rec_name(name, clause)
+        if (clause[1] == '=' and clause[2] is not None
+                or clause[1] == 'in' and isinstance(clause[2], (list, tuple))
+                and clause[2] and None not in clause[2]):
+            # Union of the name and code queries to let the database use
+            # the indexes of each
+            code_domain = cls.search_code('code',
+                ('code',) + tuple(clause[1:]))
+            return [('id', 'in', Union(
+                        cls._search_query(domain),
+                        cls._search_query(code_domain)))]
         if clause[1].startswith('!') or clause[1].startswith('not '):
             bool_op = 'AND'
         else:
@@ -50,33 +189,136 @@ class Template:
             ('code',) + tuple(clause[1:]),
             ]
 
-    def get_code(self, name):
-        if self.unique_variant:
-            with Transaction().set_context(active_test=False):
-                return self.products and self.products[0].code or None
+    @classmethod
+    def _search_query(cls, domain):
+        'Return the query of the ids matching domain without active test'
+        tables, expression = cls.search_domain(domain, active_test=False)
+        table, _ = tables[None]
+        return convert_from(None, tables).select(table.id, where=expression)
 
     @classmethod
-    def set_code(cls, templates, name, value):
-        Product = Pool().get('product.product')
+    def get_product_sum(cls, templates, name):
+        'Compute the stock fields of all the templates at once'
+        pool = Pool()
+        Product = pool.get('product.product')
+        product = Product.__table__()
+        cursor = Transaction().cursor
 
-        products = set()
+        if name not in ('quantity', 'forecast_quantity', 'cost_value'):
+            raise Exception('Bad argument')
+
+        product_ids = defaultdict(list)
+        for sub_templates in grouped_slice(templates):
+            where = reduce_ids(product.template,
+                [t.id for t in sub_templates])
+            if Transaction().context.get('active_test', True):
+                where &= product.active
+            cursor.execute(*product.select(product.template, product.id,
+                    where=where))
+            for template_id, product_id in cursor.fetchall():
+                product_ids[template_id].append(product_id)
+        products = Product.browse(list(chain(*product_ids.values())))
+        if name == 'cost_value':
+            values = Product.get_cost_value(products, name)
+        else:
+            values = Product.get_quantity(products, name)
+
+        result = {}
         for template in templates:
-            if not template.unique_variant:
-                continue
-            with Transaction().set_context(active_test=False):
-                if template.products:
-                    products.add(template.products[0])
-                elif value:
-                    new_product = Product(template=template)
-                    new_product.save()
-                    products.add(new_product)
-        if products:
-            Product.write(list(products), {
-                    'code': value,
-                    })
+            sum_ = 0. if name != 'cost_value' else Decimal(0)
+            for product_id in product_ids[template.id]:
+                sum_ += values[product_id]
+            result[template.id] = sum_
+        return result
+
+    @classmethod
+    @instrumented('template.get_code')
+    def get_code(cls, templates, name):
+        pool = Pool()
+        Product = pool.get('product.product')
+        template = cls.__table__()
+        product = Product.__table__()
+        cursor = Transaction().cursor
+
+        codes = dict((t.id, None) for t in templates)
+        # Inactive products are also taken into account
+        for sub_ids in grouped_slice(codes.keys()):
+            red_sql = reduce_ids(template.id, sub_ids)
+            cursor.execute(*template.join(product,
+                    condition=product.template == template.id
+                    ).select(product.template, product.code,
+                    where=red_sql & template.unique_variant,
+                    order_by=product.id.desc))
+            codes.update(cursor.fetchall())
+        return codes
+
+    @classmethod
+    def set_code(cls, templates, name, value):
+        cls.set_codes(dict((t.id, value) for t in templates))
+
+    @classmethod
+    @instrumented('template.set_codes')
+    def set_codes(cls, codes):
+        '''
+        Set the codes of the unique variant templates from the dictionary
+        template id: code. The missing variants are created.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+
+        unique_ids = sorted(cls.get_unique_variant_ids(codes.keys()))
+        product_ids = cls.get_variant_ids(unique_ids)
+
+        to_create = [{
+                'template': i,
+                'code': codes[i],
+                } for i in unique_ids if i not in product_ids and codes[i]]
+        if to_create:
+            Product.create(to_create)
+
+        to_write = defaultdict(list)
+        for template_id, product_id in product_ids.iteritems():
+            to_write[codes[template_id]].append(product_id)
+        args = []
+        for code, ids in to_write.iteritems():
+            args.extend((Product.browse(ids), {
+                        'code': code,
+                        }))
+        if args:
+            Product.write(*args)
 
     @classmethod
     def search_code(cls, name, clause):
+        bounds = []
+        if backend.name() != 'postgresql':
+            # PostgreSQL uses the pattern indexes with the original clause
+            # and its comparisons depend on the collation
+            bounds = prefix_range(*clause[1:3])
+        if stored_code():
+            return [
+                ('unique_variant', '=', True),
+                ('stored_code',) + tuple(clause[1:]),
+                ] + [('stored_code',) + b for b in bounds]
+        inactive = Transaction().context.get('search_inactive_products')
+        if inactive or bounds:
+            # Single subquery on the products which includes the inactive
+            # ones only when searching inactive templates
+            pool = Pool()
+            Product = pool.get('product.product')
+            product = Product.__table__()
+            context = {}
+            if inactive:
+                context['active_test'] = False
+            with Transaction().set_context(**context):
+                query = Product.search([
+                        ('code',) + tuple(clause[1:]),
+                        ] + [('code',) + b for b in bounds],
+                    order=[], query=True)
+            return [
+                ('unique_variant', '=', True),
+                ('id', 'in', product.select(product.template,
+                        where=product.id.in_(query))),
+                ]
         return [
             ('unique_variant', '=', True),
             ('products.code',) + tuple(clause[1:]),
@@ -87,6 +329,8 @@ class Template:
         pool = Pool()
         Product = pool.get('product.product')
         table, _ = tables[None]
+        if stored_code():
+            return [table.stored_code]
         product_table = tables.get('product')
         if product_table is None:
             product = Product.__table__()
@@ -99,41 +343,358 @@ class Template:
         return [table.code]
 
     @classmethod
-    def validate(cls, templates):
+    def update_stored_code(cls, templates=None):
+        '''
+        Copy the code of the unique variant into the stored_code column of the
+        templates or of all the unique variant templates if None.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        if templates is None:
+            cursor.execute(*table.select(table.id,
+                    where=table.unique_variant))
+            templates = cls.browse([i for i, in cursor.fetchall()])
+        for sub_templates in grouped_slice(templates):
+            codes = defaultdict(list)
+            for template_id, code in cls.get_code(list(sub_templates),
+                    'code').iteritems():
+                codes[code].append(template_id)
+            for code, template_ids in codes.iteritems():
+                cursor.execute(*table.update(
+                        columns=[table.stored_code],
+                        values=[code],
+                        where=reduce_ids(table.id, template_ids)))
+                clear_cache(cls, template_ids)
+
+    @classmethod
+    def get_by_code(cls, code):
+        '''
+        Return the tuple (template id, product id) of the active unique
+        variant with the code or None
+        '''
         pool = Pool()
         Product = pool.get('product.product')
-        products = []
-        for template in templates:
-            if template.unique_variant and template.products:
-                products.append(template.products[0])
-        if products:
-            Product.validate_unique_template(products)
-        super(Template, cls).validate(templates)
+        table = cls.__table__()
+        product = Product.__table__()
+        cursor = Transaction().cursor
+
+        result = cls._code_cache.get(code, -1)
+        if result != -1:
+            return result
+        cursor.execute(*product.join(table,
+                condition=product.template == table.id
+                ).select(table.id, product.id,
+                where=(product.code == code)
+                & table.unique_variant & table.active & product.active,
+                order_by=product.id, limit=1))
+        result = cursor.fetchone()
+        if result:
+            result = tuple(result)
+        cls._code_cache.set(code, result)
+        return result
 
     @classmethod
-    def search_domain(cls, domain, active_test=True, tables=None):
-        def find_active_code(domain):
-            active_found = code_found = False
-            for arg in domain:
-                if (isinstance(arg, (tuple, list)) and len(arg) == 3
-                        and (tuple(arg) == ('active', '=', False)
-                            or (arg[0] == 'active' and arg[1] == 'in'
-                                and False in arg[2]))):
-                    active_found = True
-                elif (isinstance(arg, tuple)
-                        or (isinstance(arg, list)
-                            and len(arg) > 2
-                            and arg[1] in OPERATORS)):
-                    if arg[0] in ('code', 'rec_name'):
-                        code_found = True
-                elif isinstance(arg, list):
-                    active_found_rec, code_found_rec = find_active_code(arg)
-                    active_found |= active_found_rec
-                    code_found |= code_found_rec
-                if active_found and code_found:
-                    break
-            return active_found, code_found
+    def get_variant_ids(cls, ids):
+        '''
+        Return a dictionary with the id of the first variant, active or not,
+        of the template ids that have one
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        product = Product.__table__()
+        cursor = Transaction().cursor
+
+        product_ids = {}
+        for sub_ids in grouped_slice(list(ids)):
+            cursor.execute(*product.select(product.template, product.id,
+                    where=reduce_ids(product.template, sub_ids),
+                    order_by=product.id.desc))
+            product_ids.update(cursor.fetchall())
+        return product_ids
+
+    @classmethod
+    def prefetch_products(cls, templates, count=None):
+        '''
+        Yield the templates by chunk of count after filling their products in
+        the record cache with one query. Only the chunk being consumed is
+        fetched so the earlier ones may be evicted from the cache once read.
+        As for the One2Many, the inactive products are included only if
+        active_test is False.
+
+        The module does not use it, it is an API for the modules which read
+        the products of many templates:
+
+            for template in Template.prefetch_products(templates):
+                ... template.products ...
+
+        The values are stored in the record cache as ModelStorage does when
+        it reads the One2Many, as there is no public API to fill it.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        product = Product.__table__()
+        transaction = Transaction()
+        cursor = transaction.cursor
+
+        for sub_templates in grouped_slice(templates, count):
+            sub_templates = list(sub_templates)
+            product_ids = dict((t.id, []) for t in sub_templates)
+            query = Product.search([
+                    ('template', 'in', product_ids.keys()),
+                    ], order=[], query=True)
+            cursor.execute(*product.select(product.id, product.template,
+                    where=product.id.in_(query),
+                    order_by=product.id))
+            for product_id, template_id in cursor.fetchall():
+                product_ids[template_id].append(product_id)
+            products = Product.browse(list(chain(*product_ids.values())))
+            products = dict((p.id, p) for p in products)
+            for template in sub_templates:
+                local_cache = template._local_cache
+                if local_cache.counter != transaction.counter:
+                    local_cache.clear()
+                    local_cache.counter = transaction.counter
+                local_cache.setdefault(template.id, {})['products'] = tuple(
+                    products[i] for i in product_ids[template.id])
+            for template in sub_templates:
+                yield template
+
+    @classmethod
+    def get_unique_variant_ids(cls, ids):
+        'Return the set of ids that are unique variant templates'
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        unique_ids = set()
+        for sub_ids in grouped_slice(list(ids)):
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & table.unique_variant))
+            unique_ids.update(i for i, in cursor.fetchall())
+        return unique_ids
+
+    @classmethod
+    def lock_templates(cls, ids):
+        '''
+        Lock, in id order until the end of the transaction, the rows of the
+        templates which have no variant yet to serialize the creation of
+        their variant
+        '''
+        if backend.name() != 'postgresql':
+            # SQLite serializes the writing transactions
+            return
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.cursor
+
+        # Creating a second variant is refused by the unique index anyway
+        variant_ids = cls.get_variant_ids(ids)
+        ids = sorted(set(ids) - set(variant_ids))
+        for sub_ids in grouped_slice(ids):
+            red_sql = reduce_ids(table.id, sub_ids)
+            cursor.execute(*table.select(table.id,
+                    where=red_sql, order_by=table.id, for_=For('UPDATE')))
+            # The unique index already prevents the duplicated variants.
+            # Touching the rows only makes a concurrent transaction waiting
+            # for the lock fail with a serialization error, which is retried,
+            # instead of the template_uniq error. It changes the write_uid
+            # and write_date of the template when its first variant is
+            # created.
+            cursor.execute(*table.update(
+                    columns=[table.write_uid, table.write_date],
+                    values=[transaction.user, CurrentTimestamp()],
+                    where=red_sql))
+            clear_cache(cls, sub_ids)
+
+    @classmethod
+    def set_products_unique_variant(cls, templates, value):
+        '''
+        Copy the unique variant flag of the templates on their products.
+        The unique index on the products, or the validation on the backends
+        without partial index, ensures the templates have only one variant.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        try:
+            cls._set_products_unique_variant(templates, value)
+        except DatabaseIntegrityError as exception:
+            Product.raise_template_uniq(exception)
+            raise
+
+    @classmethod
+    def _set_products_unique_variant(cls, templates, value):
+        pool = Pool()
+        Product = pool.get('product.product')
+        product = Product.__table__()
+        cursor = Transaction().cursor
 
+        for sub_templates in grouped_slice(templates):
+            cursor.execute(*product.select(product.id,
+                    where=reduce_ids(product.template,
+                        [t.id for t in sub_templates])
+                    & (product.template_unique_variant != value)))
+            product_ids = [i for i, in cursor.fetchall()]
+            if not product_ids:
+                continue
+            cursor.execute(*product.update(
+                    columns=[product.template_unique_variant],
+                    values=[value],
+                    where=reduce_ids(product.id, product_ids)))
+            clear_cache(Product, product_ids)
+            if value and not Product._unique_template_index_supported():
+                Product.validate_unique_template(Product.browse(product_ids))
+        cls._code_cache.clear()
+
+    @classmethod
+    def convert_unique_variant(cls, domain=None, chunk_size=1000,
+            commit=True):
+        '''
+        Mark as unique variant the templates matching the domain that have
+        at most one variant and return the ids of those with more variants.
+        The templates are processed by chunks in id order and each chunk is
+        committed, the conversion can be run again to resume it as the
+        converted templates are skipped.
+        '''
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.cursor
+
+        with transaction.set_context(active_test=False):
+            query = cls.search((domain or []) + [
+                    ('unique_variant', '=', False),
+                    ], order=[], query=True)
+        conflicts = []
+        last_id = 0
+        count = 0
+        start = time.time()
+        while True:
+            cursor.execute(*table.select(table.id,
+                    where=table.id.in_(query) & (table.id > last_id),
+                    order_by=table.id, limit=chunk_size))
+            ids = [i for i, in cursor.fetchall()]
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            chunk_conflicts = cls.get_unique_variant_conflicts(ids)
+            to_convert = [i for i in ids if i not in chunk_conflicts]
+            if not cls._convert_unique_variant(to_convert):
+                # A variant was created concurrently
+                chunk_conflicts = cls.get_unique_variant_conflicts(ids)
+                for template_id in ids:
+                    if (template_id not in chunk_conflicts
+                            and not cls._convert_unique_variant(
+                                [template_id])):
+                        chunk_conflicts.add(template_id)
+            conflicts.extend(sorted(chunk_conflicts))
+            if stored_code():
+                cls.update_stored_code(cls.browse([i for i in ids
+                            if i not in chunk_conflicts]))
+            if commit:
+                cursor.commit()
+
+            count += len(ids)
+            logger.info('%s templates processed, %s conflicts, '
+                '%.1f templates/s', count, len(conflicts),
+                count / max(time.time() - start, 1e-6))
+        return conflicts
+
+    @classmethod
+    def get_unique_variant_conflicts(cls, ids):
+        'Return the set of template ids that have more than one variant'
+        pool = Pool()
+        Product = pool.get('product.product')
+        product = Product.__table__()
+        cursor = Transaction().cursor
+
+        conflicts = set()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*product.select(product.template,
+                    where=reduce_ids(product.template, sub_ids),
+                    group_by=product.template,
+                    having=Count(product.id) > 1))
+            conflicts.update(i for i, in cursor.fetchall())
+        return conflicts
+
+    @classmethod
+    def _convert_unique_variant(cls, ids):
+        '''
+        Mark the templates and their products as unique variant and return
+        False, with nothing changed, if the unique index or the validation
+        rejects them
+        '''
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.cursor
+
+        def set_unique_variant(value):
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*table.update(
+                        columns=[table.unique_variant, table.write_uid,
+                            table.write_date],
+                        values=[value, transaction.user, CurrentTimestamp()],
+                        where=reduce_ids(table.id, sub_ids)))
+            clear_cache(cls, ids)
+            cls._set_products_unique_variant(cls.browse(ids), value)
+
+        if not ids:
+            return True
+        # A failing statement aborts the whole transaction on PostgreSQL
+        savepoint = backend.name() == 'postgresql'
+        if savepoint:
+            cursor.execute('SAVEPOINT convert_unique_variant')
+        try:
+            set_unique_variant(True)
+        except (DatabaseIntegrityError, UserError):
+            # UserError is raised by validate_unique_template on the
+            # backends without the partial unique index
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT convert_unique_variant')
+                clear_cache(cls, ids)
+            else:
+                # Only the failing statement is reverted
+                set_unique_variant(False)
+            return False
+        finally:
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT convert_unique_variant')
+        return True
+
+    @classmethod
+    def set_products_active(cls, templates, value):
+        '''
+        Set the active flag of the variant of the unique variant templates
+        without going through Product.write.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        product = Product.__table__()
+        transaction = Transaction()
+        cursor = transaction.cursor
+
+        for sub_templates in grouped_slice(templates):
+            cursor.execute(*product.select(product.id,
+                    where=reduce_ids(product.template,
+                        [t.id for t in sub_templates])
+                    & product.template_unique_variant
+                    & (product.active != value)))
+            product_ids = [i for i, in cursor.fetchall()]
+            if not product_ids:
+                continue
+            cursor.execute(*product.update(
+                    columns=[product.active, product.write_uid,
+                        product.write_date],
+                    values=[value, transaction.user, CurrentTimestamp()],
+                    where=reduce_ids(product.id, product_ids)))
+            clear_cache(Product, product_ids)
+        cls._code_cache.clear()
+
+    @classmethod
+    @instrumented('template.search_domain')
+    def search_domain(cls, domain, active_test=True, tables=None):
         active_found, code_found = find_active_code(domain)
         with Transaction().set_context(
                 search_inactive_products=(active_found and code_found)):
@@ -141,40 +702,52 @@ class Template:
                 active_test=active_test, tables=tables)
 
     @classmethod
-    def write(cls, *args):
-        pool = Pool()
-        Product = pool.get('product.product')
+    @instrumented('template.create')
+    def create(cls, vlist):
+        vlist = [v.copy() for v in vlist]
+        codes = {}
+        for i, values in enumerate(vlist):
+            if 'code' in values:
+                codes[i] = values.pop('code')
+        templates = super(Template, cls).create(vlist)
+        codes = dict((templates[i].id, c) for i, c in codes.iteritems())
+        if codes:
+            cls.set_codes(codes)
+        return templates
 
-        to_active_products = []
-        to_deactive_products = []
+    @classmethod
+    @instrumented('template.write')
+    def write(cls, *args):
+        templates = set()
         actions = iter(args)
-        for templates, values in zip(actions, actions):
-            if 'active' in values:
-                for template in templates:
-                    if template.unique_variant:
-                        with Transaction().set_context(active_test=False):
-                            if values['active']:
-                                to_active_products += [p
-                                    for p in template.products if not p.active]
-                            else:
-                                to_deactive_products += [p
-                                    for p in template.products if p.active]
+        for records, values in zip(actions, actions):
+            if 'unique_variant' in values:
+                templates.update(records)
         super(Template, cls).write(*args)
 
-        product_args = []
-        if to_active_products:
-            product_args.extend((to_active_products, {'active': True}))
-        if to_deactive_products:
-            product_args.extend((to_deactive_products, {'active': False}))
-        if product_args:
-            Product.write(*product_args)
+        # The products follow the final flag of the templates which may be
+        # written by several actions
+        if templates:
+            templates = list(templates)
+            unique_ids = cls.get_unique_variant_ids([t.id for t in templates])
+            for value in (False, True):
+                cls.set_products_unique_variant([t for t in templates
+                        if (t.id in unique_ids) == value], value)
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if 'active' in values:
+                cls.set_products_active(records, bool(values['active']))
+        if templates and stored_code():
+            cls.update_stored_code(templates)
 
 
 class Product:
     __name__ = 'product.product'
 
     unique_variant = fields.Function(fields.Boolean('Unique variant'),
-        'on_change_with_unique_variant', searcher='search_unique_variant')
+        'get_unique_variant', searcher='search_unique_variant')
+    template_unique_variant = fields.Boolean('Template Unique Variant',
+        readonly=True)
 
     @classmethod
     def __setup__(cls):
@@ -194,42 +767,238 @@ class Product:
         cls._error_messages.update({
                 'template_uniq': ('The Template of the Product Variant must '
                     'be unique.'),
+                'template_uniq_existing': ('The unique variant templates '
+                    'with ids "%s" have more than one variant.'),
                 })
 
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Template = pool.get('product.template')
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+        template = Template.__table__()
+
+        table = TableHandler(cursor, cls, module_name)
+        flag_exist = table.column_exist('template_unique_variant')
+
+        super(Product, cls).__register__(module_name)
+
+        if not flag_exist:
+            cursor.execute(*sql_table.update(
+                    columns=[sql_table.template_unique_variant],
+                    values=[True],
+                    where=sql_table.template.in_(template.select(template.id,
+                            where=template.unique_variant))))
+
+        # Only one product by unique variant template
+        table = TableHandler(cursor, cls, module_name)
+        index_name = cls._unique_template_index()
+        if (cls._unique_template_index_supported()
+                and index_name not in table._indexes):
+            cursor.execute(*sql_table.select(sql_table.template,
+                    where=sql_table.template_unique_variant,
+                    group_by=sql_table.template,
+                    having=Count(sql_table.id) > 1))
+            template_ids = [str(i) for i, in cursor.fetchall()]
+            if template_ids:
+                logger.error('Unique variant templates with many variants: '
+                    '%s', ', '.join(template_ids))
+                cls.raise_user_error('template_uniq_existing',
+                    ', '.join(template_ids))
+            cursor.execute('CREATE UNIQUE INDEX "' + index_name + '" '
+                'ON "' + cls._table + '" ("template") '
+                'WHERE "template_unique_variant"')
+
+        # Prefix and substring searches of codes, the other backends use the
+        # index of the code column
+        if backend.name() == 'postgresql':
+            index_name = cls._table + '_code_pattern_index'
+            if index_name not in table._indexes:
+                cursor.execute('CREATE INDEX "' + index_name + '" '
+                    'ON "' + cls._table + '" ("code" varchar_pattern_ops)')
+            index_name = cls._table + '_code_trgm_index'
+            cursor.execute("SELECT 1 FROM pg_extension "
+                "WHERE extname = 'pg_trgm'")
+            if not cursor.fetchone():
+                logger.warning('The pg_trgm extension is not installed, '
+                    'the substring searches of product codes scan the whole '
+                    'table')
+            elif index_name not in table._indexes:
+                cursor.execute('CREATE INDEX "' + index_name + '" '
+                    'ON "' + cls._table + '" USING gin ("code" gin_trgm_ops)')
+
+    @staticmethod
+    def _unique_template_index_supported():
+        'Return True if the backend supports the partial unique index'
+        return backend.name() in ('postgresql', 'sqlite')
+
+    @classmethod
+    def _unique_template_index(cls):
+        return cls._table + '_template_unique_variant_index'
+
+    @staticmethod
+    def default_template_unique_variant():
+        return False
+
     @fields.depends('template', '_parent_sale.unique_variant')
     def on_change_with_unique_variant(self, name=None):
         if self.template:
             return self.template.unique_variant
 
+    @classmethod
+    def get_unique_variant(cls, products, name):
+        return dict((p.id, bool(p.template_unique_variant))
+            for p in products)
+
     @classmethod
     def search_unique_variant(cls, name, clause):
         return [
-            ('template.unique_variant',) + tuple(clause[1:]),
+            ('template_unique_variant',) + tuple(clause[1:]),
             ]
 
+    @classmethod
+    @instrumented('product.create')
+    def create(cls, vlist):
+        pool = Pool()
+        Template = pool.get('product.template')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+
+        vlist = [v.copy() for v in vlist]
+        unique_ids = Template.get_unique_variant_ids(
+            set(v['template'] for v in vlist if v.get('template')))
+        for values in vlist:
+            values['template_unique_variant'] = (
+                values.get('template') in unique_ids)
+        if unique_ids:
+            Template.lock_templates(unique_ids)
+        try:
+            products = super(Product, cls).create(vlist)
+        except DatabaseIntegrityError as exception:
+            cls.raise_template_uniq(exception)
+            raise
+        if any(v.get('code') for v in vlist):
+            Template._code_cache.clear()
+        if stored_code():
+            Template.update_stored_code(
+                list(set(p.template for p in products)))
+        return products
+
+    @classmethod
+    @instrumented('product.write')
+    def write(cls, *args):
+        pool = Pool()
+        Template = pool.get('product.template')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+
+        args = list(args)
+        templates = set()
+        clear_code_cache = False
+        actions = iter(args)
+        for i, (products, values) in enumerate(zip(actions, actions)):
+            if 'code' in values or 'template' in values:
+                templates.update(p.template for p in products)
+            if set(values) & set(['code', 'template', 'active']):
+                clear_code_cache = True
+            if 'template' in values:
+                values = values.copy()
+                values['template_unique_variant'] = bool(values['template']
+                    and Template.get_unique_variant_ids([values['template']]))
+                args[2 * i + 1] = values
+            if values.get('template'):
+                templates.add(Template(values['template']))
+        try:
+            super(Product, cls).write(*args)
+        except DatabaseIntegrityError as exception:
+            cls.raise_template_uniq(exception)
+            raise
+        if clear_code_cache:
+            Template._code_cache.clear()
+        if templates and stored_code():
+            Template.update_stored_code(list(templates))
+
+    @classmethod
+    def delete(cls, products):
+        pool = Pool()
+        Template = pool.get('product.template')
+        templates = list(set(p.template for p in products))
+        super(Product, cls).delete(products)
+        Template._code_cache.clear()
+        if stored_code():
+            Template.update_stored_code(templates)
+
     @classmethod
     def validate(cls, products):
-        cls.validate_unique_template(products)
         super(Product, cls).validate(products)
+        if not cls._unique_template_index_supported():
+            cls.validate_unique_template(products)
 
     @classmethod
-    def validate_unique_template(cls, products):
-        unique_products = list(set(p for p in products if p.unique_variant))
-        templates = [p.template.id for p in unique_products]
-        if len(set(templates)) != len(templates):
-            cls.raise_user_error('template_uniq')
-        if cls.search([
-                    ('id', 'not in', [p.id for p in unique_products]),
-                    ('template', 'in', templates),
-                    ], limit=1):
-            cls.raise_user_error('template_uniq')
+    def raise_template_uniq(cls, exception):
+        '''
+        Raise the template_uniq error if the integrity error exception comes
+        from the unique variant index
+        '''
+        message = str(exception)
+        if (cls._unique_template_index() in message
+                or '%s.template' % cls._table in message):
+            with Transaction().new_cursor(), \
+                    Transaction().set_context(_check_access=False):
+                cls.raise_user_error('template_uniq')
 
     @classmethod
-    def search_domain(cls, domain, active_test=True, tables=None):
-        if Transaction().context.get('search_inactive_products'):
-            active_test = False
-        return super(Product, cls).search_domain(domain,
-            active_test=active_test, tables=tables)
+    @instrumented('product.validate_unique_template')
+    def validate_unique_template(cls, products):
+        '''
+        Check that the unique variant templates of the products have only one
+        variant. This is enforced by the database on create and write when
+        the backend supports the partial unique index.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        template_ids = list(set(p.template.id for p in products))
+        for sub_ids in grouped_slice(template_ids):
+            cursor.execute(*table.select(table.template,
+                    where=reduce_ids(table.template, sub_ids)
+                    & table.template_unique_variant,
+                    group_by=table.template,
+                    having=Count(table.id) > 1,
+                    limit=1))
+            if cursor.fetchone():
+                cls.raise_user_error('template_uniq')
+
+
+def check_unique_variant(wizard, template_ids):
+    '''
+    Raise the not_unique_variant error of the wizard with all the templates
+    that are not unique variant
+    '''
+    pool = Pool()
+    Template = pool.get('product.template')
+    unique_ids = Template.get_unique_variant_ids(template_ids)
+    templates = Template.browse([i for i in template_ids
+            if i not in unique_ids])
+    if templates:
+        wizard.raise_user_error('not_unique_variant',
+            '", "'.join(t.rec_name for t in templates))
+
+
+def open_products_stock(product_ids, location_ids, date=None):
+    '''
+    Return the action which shows the stock of the products at the locations
+    '''
+    date = date or datetime.date.max
+    action = StateAction('stock.act_products_by_locations').get_action()
+    action['pyson_domain'] = PYSONEncoder().encode([
+            ('id', 'in', product_ids),
+            ])
+    action['pyson_context'] = PYSONEncoder().encode({
+            'locations': location_ids,
+            'stock_date_end': Date(date.year, date.month, date.day),
+            })
+    return action, {}
 
 
 class ProductByLocation:
@@ -244,27 +1013,34 @@ class ProductByLocation:
                 })
 
     def default_start(self, fields):
-        Template = Pool().get('product.template')
         try:
             res = super(ProductByLocation, self).default_start(fields)
         except AttributeError:
             res = {}
         context = Transaction().context
         if context['active_model'] == 'product.template':
-            template = Template(context['active_id'])
-            if not template.unique_variant:
-                self.raise_user_error('not_unique_variant', template.rec_name)
+            check_unique_variant(self, context['active_ids'])
         return res
 
     def do_open(self, action):
-        Template = Pool().get('product.template')
+        pool = Pool()
+        Template = pool.get('product.template')
+        Location = pool.get('stock.location')
 
         context = Transaction().context
         if context['active_model'] == 'product.template':
-            template = Template(context['active_id'])
-            if not template.products:
+            variant_ids = Template.get_variant_ids(context['active_ids'])
+            product_ids = [variant_ids[i] for i in context['active_ids']
+                if i in variant_ids]
+            if not product_ids:
                 return None, {}
-            product_id = template.products[0].id
+            if len(product_ids) > 1:
+                warehouses = Location.search([
+                        ('type', '=', 'warehouse'),
+                        ])
+                return open_products_stock(product_ids,
+                    [w.id for w in warehouses], self.start.forecast_date)
+            product_id, = product_ids
             new_context = {
                 'active_model': 'product.template',
                 'active_id': product_id,
@@ -287,7 +1063,6 @@ class OpenProductQuantitiesByWarehouse:
                 })
 
     def default_start(self, fields):
-        Template = Pool().get('product.template')
         try:
             res = super(OpenProductQuantitiesByWarehouse, self).default_start(
                 fields)
@@ -295,9 +1070,7 @@ class OpenProductQuantitiesByWarehouse:
             res = {}
         context = Transaction().context
         if context['active_model'] == 'product.template':
-            template = Template(context['active_id'])
-            if not template.unique_variant:
-                self.raise_user_error('not_unique_variant', template.rec_name)
+            check_unique_variant(self, context['active_ids'])
         return res
 
     def do_open_(self, action):
@@ -305,10 +1078,15 @@ class OpenProductQuantitiesByWarehouse:
 
         context = Transaction().context
         if context['active_model'] == 'product.template':
-            template = Template(context['active_id'])
-            if not template.products:
+            variant_ids = Template.get_variant_ids(context['active_ids'])
+            product_ids = [variant_ids[i] for i in context['active_ids']
+                if i in variant_ids]
+            if not product_ids:
                 return None, {}
-            product_id = template.products[0].id
+            if len(product_ids) > 1:
+                return open_products_stock(product_ids,
+                    [self.start.warehouse.id])
+            product_id, = product_ids
             new_context = {
                 'active_model': 'product.template',
                 'active_id': product_id,
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the unique variant hot paths on a synthetic catalog.
+
+It runs on the test database of trytond.tests.test_tryton, so DB_NAME and
+the trytond configuration select SQLite or PostgreSQL, for example:
+
+    DB_NAME=:memory: python tests/benchmark_product_variant_unique.py \\
+        --templates 10000 --output result.json
+
+The results are written as JSON with the wall time and the number of SQL
+statements of each operation. Nothing is committed except by the
+concurrent creation stress test (--stress-workers) which needs a database
+shared by the threads and removes its records at the end.
+'''
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from decimal import Decimal
+from itertools import islice
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond import backend
+from trytond.cache import LRUDict
+from trytond.exceptions import UserError
+from trytond.transaction import Transaction
+from trytond.modules.product_variant_unique.product import find_active_code
+
+
+class QueryCounter(object):
+    'Count the SQL statements executed by the transaction cursor'
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self):
+        cursor = Transaction().cursor
+        execute = cursor.execute
+
+        def counted_execute(*args, **kwargs):
+            self.count += 1
+            return execute(*args, **kwargs)
+        cursor.execute = counted_execute
+        self.cursor = cursor
+        return self
+
+    def __exit__(self, type, value, traceback):
+        del self.cursor.execute
+
+
+def domain_key(domain):
+    'Return a hashable form of the domain keeping lists and tuples apart'
+    if isinstance(domain, list):
+        return ('list',) + tuple(domain_key(d) for d in domain)
+    elif isinstance(domain, tuple):
+        return ('tuple',) + tuple(domain_key(d) for d in domain)
+    return domain
+
+
+def cached_find_active_code(cache, domain):
+    '''
+    The find_active_code analysis cached in a LRU by domain, compared to the
+    plain walk used by Template.search_domain
+    '''
+    key = domain_key(domain)
+    try:
+        result = cache[key] = cache.pop(key)
+    except KeyError:
+        result = cache[key] = find_active_code(domain)
+    return result
+
+
+class Benchmark(object):
+
+    def __init__(self, templates=10000, multi_ratio=0.1, page_size=1000,
+            lookups=100, seed=0):
+        self.templates = templates
+        self.multi_ratio = multi_ratio
+        self.page_size = page_size
+        self.lookups = lookups
+        self.random = random.Random(seed)
+        self.results = []
+
+    def measure(self, name, function, *args, **kwargs):
+        with QueryCounter() as counter:
+            start = time.time()
+            result = function(*args, **kwargs)
+            seconds = time.time() - start
+        self.results.append({
+                'name': name,
+                'seconds': seconds,
+                'queries': counter.count,
+                })
+        sys.stderr.write('%-30s %10.3fs %8d queries\n'
+            % (name, seconds, counter.count))
+        return result
+
+    def template_values(self, names):
+        for name in names:
+            yield {
+                'name': name,
+                'type': 'goods',
+                'list_price': Decimal(1),
+                'cost_price': Decimal(0),
+                'cost_price_method': 'fixed',
+                'default_uom': self.uom.id,
+                }
+
+    def create_catalog(self, chunk_size=1000):
+        'Create the unique and multi-variant templates'
+        Template = POOL.get('product.template')
+        Product = POOL.get('product.product')
+
+        self.unique_templates = []
+        self.codes = []
+        multi = int(self.templates * self.multi_ratio)
+        vlist = iter(self.template_values('Template %s' % i
+                for i in xrange(self.templates)))
+        index = 0
+        while True:
+            chunk = list(islice(vlist, chunk_size))
+            if not chunk:
+                break
+            for values in chunk:
+                if index >= multi:
+                    values['unique_variant'] = True
+                    # Digits only to let prefix_range rewrite the prefixes
+                    values['code'] = '%08d' % index
+                    self.codes.append(values['code'])
+                index += 1
+            templates = Template.create(chunk)
+            Product.create([{
+                        'template': t.id,
+                        'code': '%s-%s' % (t.id, i),
+                        } for t in templates if not t.unique_variant
+                    for i in range(2)])
+            self.unique_templates.extend(t for t in templates
+                if t.unique_variant)
+
+    def run(self):
+        Template = POOL.get('product.template')
+        Product = POOL.get('product.product')
+        Uom = POOL.get('product.uom')
+
+        self.uom, = Uom.search([('name', '=', 'Unit')])
+        self.measure('create catalog', self.create_catalog)
+
+        codes = self.random.sample(self.codes,
+            min(self.lookups, len(self.codes)))
+        self.measure('search code', lambda: [Template.search([
+                        ('code', '=', c),
+                        ]) for c in codes])
+        self.measure('search rec_name', lambda: [Template.search([
+                        ('rec_name', '=', c),
+                        ]) for c in codes])
+        prefixes = [c[:-2] + '%' for c in codes]
+        self.measure('search code prefix', lambda: [Template.search([
+                        ('code', 'ilike', p),
+                        ]) for p in prefixes])
+        substrings = ['%' + c[3:-1] + '%' for c in codes]
+        self.measure('search code substring', lambda: [Template.search([
+                        ('code', 'ilike', s),
+                        ]) for s in substrings])
+        self.measure('search order code', Template.search, [],
+            order=[('code', 'ASC')], limit=self.page_size)
+
+        domains = [[('code', '=', c)] for c in codes]
+        domains += [['OR',
+                ('rec_name', 'ilike', p),
+                [('active', '=', False), ('name', 'ilike', p)],
+                ] for p in prefixes]
+        domains += [[('active', 'in', [True, False]), ('category', '=', None),
+                ['OR', ('code', 'in', codes[:10]), ('id', '>', 0)],
+                ] for _ in codes]
+        self.measure('find_active_code', lambda: [find_active_code(d)
+                for _ in xrange(100) for d in domains])
+        cache = LRUDict(1024)
+        self.measure('find_active_code cached', lambda: [
+                cached_find_active_code(cache, d)
+                for _ in xrange(100) for d in domains])
+
+        page = self.unique_templates[:self.page_size]
+        ids = [t.id for t in page]
+        self.measure('read code', Template.read, ids, ['code'])
+        self.measure('read products', lambda: [t.products
+                for t in Template.browse(ids)])
+
+        def prefetch_products():
+            return [t.products for t in Template.prefetch_products(
+                    Template.browse(ids))]
+        self.measure('read products prefetch', prefetch_products)
+        self.measure('write deactivate', Template.write, page,
+            {'active': False})
+        self.measure('write activate', Template.write, page,
+            {'active': True})
+
+        def import_templates():
+            vlist = list(self.template_values('Import %s' % i
+                    for i in xrange(self.page_size)))
+            for i, values in enumerate(vlist):
+                values['unique_variant'] = True
+                values['code'] = 'I%08d' % i
+            return Template.create(vlist)
+        self.measure('set_code import', import_templates)
+
+        products = Product.search([
+                ('template', 'in', ids),
+                ])
+        self.measure('validate_unique_template',
+            Product.validate_unique_template, products)
+
+    def stress(self, workers, templates=1000, batch_size=100, retries=10):
+        '''
+        Set in parallel by each worker the code of the same unique variant
+        templates without variant and check that only one variant is created
+        by template
+        '''
+        Template = POOL.get('product.template')
+        Product = POOL.get('product.product')
+        Uom = POOL.get('product.uom')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) as t:
+            self.uom, = Uom.search([('name', '=', 'Unit')])
+            vlist = list(self.template_values('Stress %s' % i
+                    for i in xrange(templates)))
+            for values in vlist:
+                values['unique_variant'] = True
+            template_ids = [x.id for x in Template.create(vlist)]
+            t.cursor.commit()
+
+        def work(ids, code, stats):
+            with Transaction().start(DB_NAME, USER, context=CONTEXT) as t:
+                for start in xrange(0, len(ids), batch_size):
+                    batch = ids[start:start + batch_size]
+                    for retry in xrange(retries + 1):
+                        try:
+                            Template.set_codes(dict((template_id, code)
+                                    for template_id in batch))
+                            t.cursor.commit()
+                            break
+                        except DatabaseOperationalError:
+                            t.cursor.rollback()
+                            stats['retries'] += 1
+                        except UserError:
+                            # Without row locks (SQLite) the unique index
+                            # rejects the second variant
+                            t.cursor.rollback()
+                            stats['conflicts'] += 1
+                    else:
+                        stats['errors'] += 1
+
+        try:
+            for count in workers:
+                stats = [{
+                        'retries': 0,
+                        'conflicts': 0,
+                        'errors': 0,
+                        } for _ in xrange(count)]
+                threads = []
+                for n in xrange(count):
+                    ids = template_ids[:]
+                    self.random.shuffle(ids)
+                    threads.append(threading.Thread(target=work,
+                            args=(ids, 'S%s' % count, stats[n])))
+                start = time.time()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                seconds = time.time() - start
+
+                with Transaction().start(DB_NAME, USER,
+                        context=CONTEXT) as t:
+                    products = Product.search([
+                            ('template', 'in', template_ids),
+                            ])
+                    variants = {}
+                    for product in products:
+                        variants.setdefault(product.template.id, 0)
+                        variants[product.template.id] += 1
+                    Product.delete(products)
+                    t.cursor.commit()
+                result = {
+                    'name': 'stress %s workers' % count,
+                    'seconds': seconds,
+                    'workers': count,
+                    'templates': templates,
+                    'retries': sum(s['retries'] for s in stats),
+                    'conflicts': sum(s['conflicts'] for s in stats),
+                    'errors': sum(s['errors'] for s in stats),
+                    'missing': templates - len(variants),
+                    'duplicated': sum(1 for v in variants.itervalues()
+                        if v > 1),
+                    }
+                self.results.append(result)
+                sys.stderr.write('%-30s %10.3fs %8d retries %d conflicts '
+                    '%d errors %d missing %d duplicated\n' % (
+                        result['name'], seconds, result['retries'],
+                        result['conflicts'], result['errors'],
+                        result['missing'], result['duplicated']))
+        finally:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT) as t:
+                Template.delete(Template.browse(template_ids))
+                t.cursor.commit()
+
+    def result(self):
+        return {
+            'backend': backend.name(),
+            'templates': self.templates,
+            'multi_ratio': self.multi_ratio,
+            'page_size': self.page_size,
+            'lookups': self.lookups,
+            'results': self.results,
+            }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark product_variant_unique')
+    parser.add_argument('--templates', type=int, default=10000,
+        help='number of templates of the catalog')
+    parser.add_argument('--multi-ratio', type=float, default=0.1,
+        help='ratio of templates with two variants')
+    parser.add_argument('--page-size', type=int, default=1000,
+        help='number of records by list page')
+    parser.add_argument('--lookups', type=int, default=100,
+        help='number of searches by code')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stress-workers',
+        type=lambda v: [int(w) for w in v.split(',')], default=[],
+        help='comma separated numbers of concurrent workers to test')
+    parser.add_argument('--stress-templates', type=int, default=1000,
+        help='number of templates of the concurrent workers')
+    parser.add_argument('--output', help='JSON file of the results')
+    options = parser.parse_args(args)
+
+    trytond.tests.test_tryton.install_module('product_variant_unique')
+    benchmark = Benchmark(templates=options.templates,
+        multi_ratio=options.multi_ratio, page_size=options.page_size,
+        lookups=options.lookups, seed=options.seed)
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        benchmark.run()
+    if options.stress_workers:
+        benchmark.stress(options.stress_workers,
+            templates=options.stress_templates)
+    result = json.dumps(benchmark.result(), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(result)
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,23 @@
 #!/usr/bin/env python
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import random
+import threading
 import unittest
 from decimal import Decimal
+from itertools import islice
+from StringIO import StringIO
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import ModuleTestCase
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond import backend
+from trytond.config import config
 from trytond.exceptions import UserError
+from trytond.pyson import PYSONDecoder
 from trytond.transaction import Transaction
+from trytond.modules.product_variant_unique import instrument
+from trytond.modules.product_variant_unique.importer import import_csv
+from trytond.modules.product_variant_unique.product import find_active_code
 
 
 class TestProductVariantCase(ModuleTestCase):
@@ -21,6 +31,12 @@ class TestProductVariantCase(ModuleTestCase):
         self.category = POOL.get('product.category')
         self.uom = POOL.get('product.uom')
 
+    def tearDown(self):
+        # The default unique_variant is cached outside of the transaction
+        Configuration = POOL.get('product.configuration')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            Configuration._unique_variant_cache.clear()
+
     def test0010_unique_variant(self):
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             category, = self.category.create([{
@@ -62,18 +78,6 @@ class TestProductVariantCase(ModuleTestCase):
             self.assertIsNone(template.code)
             self.assertEqual(sorted(p.code for p in products), ['1', '2'])
 
-            with self.assertRaises(UserError) as cm:
-                self.product.create([{
-                            'code': '1',
-                            'template': uniq_template.id,
-                            }, {
-                            'code': '2',
-                            'template': uniq_template.id,
-                            }])
-            self.assertEqual(cm.exception.message,
-                'The Template of the Product Variant must be unique.')
-
-            self.product.delete(uniq_template.products)
             self.product.create([{
                         'code': '1',
                         'template': uniq_template.id,
@@ -86,6 +90,12 @@ class TestProductVariantCase(ModuleTestCase):
             self.assertEqual(self.template.search([
                         ('rec_name', '=', '1'),
                         ]), [uniq_template])
+            self.assertEqual(self.template.search([
+                        ('rec_name', 'in', ['1', 'Test variant']),
+                        ], order=[('id', 'ASC')]), [template, uniq_template])
+            self.assertEqual(self.template.search([
+                        ('rec_name', '=', 'Test variant'),
+                        ]), [template])
             self.template.write([uniq_template], {'code': '2'})
             self.assertEqual(uniq_template.code, '2')
             self.assertEqual(uniq_template.products[0].code, '2')
@@ -97,6 +107,837 @@ class TestProductVariantCase(ModuleTestCase):
             self.assertEqual(cm.exception.message,
                 'The Template of the Product Variant must be unique.')
 
+    def test0015_unique_variant_constraint(self):
+        TableHandler = backend.get('TableHandler')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            uniq_template, = self.template.create([{
+                        'name': 'Test unique variant',
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'unique_variant': True,
+                        }])
+            with self.assertRaises(UserError) as cm:
+                self.product.create([{
+                            'code': '1',
+                            'template': uniq_template.id,
+                            }, {
+                            'code': '2',
+                            'template': uniq_template.id,
+                            }])
+            self.assertEqual(cm.exception.message,
+                'The Template of the Product Variant must be unique.')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            template, = self.template.create([{
+                        'name': 'Test variant',
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'products': [('create', [{
+                                        'code': '1',
+                                        }, {
+                                        'code': '2',
+                                        }])],
+                        }])
+            with self.assertRaises(UserError) as cm:
+                self.template.write([template], {'unique_variant': True})
+            self.assertEqual(cm.exception.message,
+                'The Template of the Product Variant must be unique.')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            cursor = Transaction().cursor
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            template, = self.template.create([{
+                        'name': 'Test existing variants',
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'products': [('create', [{
+                                        'code': '1',
+                                        }, {
+                                        'code': '2',
+                                        }])],
+                        }])
+            cursor.execute('DROP INDEX "%s"'
+                % self.product._unique_template_index())
+            table = self.product.__table__()
+            cursor.execute(*table.update([table.template_unique_variant],
+                    [True], where=table.template == template.id))
+            try:
+                with self.assertRaises(UserError) as cm:
+                    self.product.__register__('product_variant_unique')
+                self.assertEqual(cm.exception.message,
+                    'The unique variant templates with ids "%s" have more '
+                    'than one variant.' % template.id)
+            finally:
+                # SQLite commits before the DDL statements
+                self.product.delete(self.product.browse(
+                        [p.id for p in template.products]))
+                self.template.delete([template])
+                self.product.__register__('product_variant_unique')
+                cursor.commit()
+            table = TableHandler(cursor, self.product,
+                'product_variant_unique')
+            self.assertIn(self.product._unique_template_index(),
+                table._indexes)
+
+    def test0020_stored_code(self):
+        if not config.has_section('product_variant_unique'):
+            config.add_section('product_variant_unique')
+        config.set('product_variant_unique', 'stored_code', 'True')
+        try:
+            self._test_stored_code()
+        finally:
+            config.remove_option('product_variant_unique', 'stored_code')
+
+    def _test_stored_code(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            template1, template2, template3 = self.template.create([{
+                        'name': 'Test stored code %s' % i,
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'unique_variant': unique_variant,
+                        } for i, unique_variant in enumerate(
+                        [True, True, False])])
+            self.template.write([template1], {'code': 'B'})
+            self.template.write([template2], {'code': 'A'})
+            product3, = self.product.create([{
+                        'code': 'A',
+                        'template': template3.id,
+                        }])
+            self.assertEqual(template1.stored_code, 'B')
+            self.assertEqual(template2.stored_code, 'A')
+            self.assertIsNone(template3.stored_code)
+
+            self.assertEqual(self.template.search([
+                        ('code', '=', 'A'),
+                        ]), [template2])
+            self.assertEqual(self.template.search([
+                        ('id', 'in', [template1.id, template2.id]),
+                        ], order=[('code', 'ASC')]), [template2, template1])
+
+            self.product.write(list(template1.products), {'code': 'C'})
+            self.assertEqual(self.template.search([
+                        ('code', '=', 'C'),
+                        ]), [template1])
+
+            self.product.delete(list(template2.products))
+            self.assertEqual(self.template.search([
+                        ('code', '=', 'A'),
+                        ]), [])
+
+            self.template.write([template3], {'unique_variant': True})
+            self.assertEqual(template3.stored_code, 'A')
+
+    def test0030_active(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            template, uniq_template = self.template.create([{
+                        'name': 'Test active %s' % i,
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'unique_variant': unique_variant,
+                        'products': [('create', [{
+                                        'code': str(i),
+                                        }])],
+                        } for i, unique_variant in enumerate([False, True])])
+            product, = template.products
+            uniq_product, = uniq_template.products
+            self.assertFalse(product.unique_variant)
+            self.assertTrue(uniq_product.unique_variant)
+            self.assertEqual(self.product.search([
+                        ('id', 'in', [product.id, uniq_product.id]),
+                        ('unique_variant', '=', True),
+                        ]), [uniq_product])
+
+            self.template.write([template, uniq_template], {'active': False})
+            self.assertTrue(product.active)
+            self.assertFalse(uniq_product.active)
+            self.assertEqual(self.product.search([
+                        ('id', 'in', [product.id, uniq_product.id]),
+                        ]), [product])
+
+            self.assertEqual(self.template.search([
+                        ('code', '=', '1'),
+                        ('active', '=', False),
+                        ]), [uniq_template])
+            self.assertEqual(self.template.search([
+                        ('rec_name', '=', '1'),
+                        ('active', 'in', [True, False]),
+                        ]), [uniq_template])
+
+            self.template.write([uniq_template], {'active': True})
+            self.assertTrue(uniq_product.active)
+
+            self.template.write([template], {'unique_variant': True},
+                [template], {'unique_variant': False})
+            self.assertFalse(template.unique_variant)
+            self.assertFalse(product.template_unique_variant)
+            self.assertFalse(product.unique_variant)
+            self.template.write([uniq_template], {'unique_variant': False},
+                [uniq_template], {'unique_variant': True})
+            self.assertTrue(uniq_product.template_unique_variant)
+            self.assertEqual(self.product.search([
+                        ('id', 'in', [product.id, uniq_product.id]),
+                        ('unique_variant', '=', True),
+                        ]), [uniq_product])
+
+            def product_queries(*args):
+                queries = []
+                cursor = Transaction().cursor
+                execute = cursor.execute
+
+                def counted_execute(query, *params):
+                    if 'product_product' in query:
+                        queries.append(query)
+                    return execute(query, *params)
+                cursor.execute = counted_execute
+                try:
+                    self.template.write(*args)
+                finally:
+                    del cursor.execute
+                return queries
+
+            # The other fields do not synchronize the products
+            self.assertEqual(product_queries([template, uniq_template], {
+                        'list_price': Decimal(2),
+                        }), [])
+            self.assertNotEqual(product_queries([template], {
+                        'unique_variant': True,
+                        }), [])
+
+    def test0045_stored_code_switched_on(self):
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            template, = self.template.create([{
+                        'name': 'Test stored code switched on',
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'unique_variant': True,
+                        'products': [('create', [{
+                                        'code': 'S1',
+                                        }])],
+                        }])
+            self.assertIsNone(template.stored_code)
+
+            if not config.has_section('product_variant_unique'):
+                config.add_section('product_variant_unique')
+            config.set('product_variant_unique', 'stored_code', 'True')
+            try:
+                self.template.__register__('product_variant_unique')
+                template = self.template(template.id)
+                self.assertEqual(template.stored_code, 'S1')
+                self.assertEqual(self.template.search([
+                            ('code', '=', 'S1'),
+                            ]), [template])
+            finally:
+                config.remove_option('product_variant_unique', 'stored_code')
+                # SQLite commits before the DDL statements
+                self.product.delete(list(template.products))
+                self.template.delete([template])
+                transaction.cursor.commit()
+
+    def test0050_create_code(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            templates = self.template.create([{
+                        'name': 'Test create code %s' % i,
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'unique_variant': unique_variant,
+                        'code': code,
+                        } for i, (unique_variant, code) in enumerate([
+                            (True, 'A'), (True, None), (False, 'C')])])
+            self.assertEqual([t.code for t in templates], ['A', None, None])
+            self.assertEqual([len(t.products) for t in templates], [1, 0, 0])
+            self.assertEqual(templates[0].products[0].code, 'A')
+
+    def test0060_find_active_code(self):
+        self.assertEqual(find_active_code(['OR', [
+                        ('active', 'in', [True, False]),
+                        ('rec_name', 'ilike', '%1%'),
+                        ], ('name', '=', 'Test')]),
+            (True, True))
+        self.assertEqual(find_active_code(
+                [['code', '=', '1'], ['active', '=', False]]),
+            (True, True))
+        self.assertEqual(find_active_code(
+                [['code', '=', '1'], ('active', '=', True)]),
+            (False, True))
+        self.assertEqual(find_active_code(
+                [('code', 'in', set(['1']))]),
+            (False, True))
+
+    def test0070_get_by_code(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            template, = self.template.create([{
+                        'name': 'Test get by code',
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'unique_variant': True,
+                        'code': 'A',
+                        }])
+            product, = template.products
+            self.assertEqual(self.template.get_by_code('A'),
+                (template.id, product.id))
+            self.assertIsNone(self.template.get_by_code('B'))
+
+            self.template.write([template], {'code': 'B'})
+            self.assertIsNone(self.template.get_by_code('A'))
+            self.assertEqual(self.template.get_by_code('B'),
+                (template.id, product.id))
+
+            self.template.write([template], {'active': False})
+            self.assertIsNone(self.template.get_by_code('B'))
+
+    def test0080_convert_unique_variant(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            templates = self.template.create([{
+                        'name': 'Test convert %s' % i,
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'products': [('create', [{
+                                            'code': '%s-%s' % (i, j),
+                                            } for j in range(n)])],
+                        } for i, n in enumerate([0, 1, 2, 1])])
+            conflicts = self.template.convert_unique_variant(
+                domain=[('id', 'in', [t.id for t in templates])],
+                chunk_size=2, commit=False)
+            self.assertEqual(conflicts, [templates[2].id])
+            self.assertEqual([t.unique_variant for t in templates],
+                [True, True, False, True])
+            self.assertEqual(templates[3].code, '3-0')
+            self.assertTrue(templates[1].products[0].unique_variant)
+
+            # Variants created after the conflicts detection
+            template, = self.template.create([{
+                        'name': 'Test convert concurrent',
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'products': [('create', [{
+                                        'code': 'C%s' % j,
+                                        } for j in range(2)])],
+                        }])
+            self.template.get_unique_variant_conflicts = classmethod(
+                lambda cls, ids: set())
+            try:
+                conflicts = self.template.convert_unique_variant(
+                    domain=[('id', 'in', [templates[2].id, template.id])],
+                    commit=False)
+            finally:
+                del self.template.get_unique_variant_conflicts
+            self.assertEqual(conflicts, [templates[2].id, template.id])
+            self.assertFalse(template.unique_variant)
+            self.assertFalse(any(p.template_unique_variant
+                    for p in template.products))
+
+        # Without the unique index the validation rejects the conflicts
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            cursor = transaction.cursor
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            templates = self.template.create([{
+                        'name': 'Test convert validate %s' % i,
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'products': [('create', [{
+                                        'code': 'V%s-%s' % (i, j),
+                                        } for j in range(n)])],
+                        } for i, n in enumerate([2, 1])])
+            cursor.execute('DROP INDEX "%s"'
+                % self.product._unique_template_index())
+            self.product._unique_template_index_supported = staticmethod(
+                lambda: False)
+            self.template.get_unique_variant_conflicts = classmethod(
+                lambda cls, ids: set())
+            try:
+                conflicts = self.template.convert_unique_variant(
+                    domain=[('id', 'in', [t.id for t in templates])],
+                    commit=False)
+                self.assertEqual(conflicts, [templates[0].id])
+                self.assertEqual([t.unique_variant for t in templates],
+                    [False, True])
+                self.assertFalse(any(p.template_unique_variant
+                        for p in templates[0].products))
+            finally:
+                del self.template.get_unique_variant_conflicts
+                del self.product._unique_template_index_supported
+                # SQLite commits before the DDL statements
+                self.product.delete(self.product.browse(
+                        [p.id for t in templates for p in t.products]))
+                self.template.delete(templates)
+                self.product.__register__('product_variant_unique')
+                cursor.commit()
+
+    def test0090_import_csv(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            csv_file = StringIO('name,code,list_price,cost_price,default_uom\n'
+                'Import 1,I1,10,5,kg\n'
+                'Import 2,I2,wrong,5,kg\n'
+                ',I3,10,5,kg\n'
+                'Import 4,I1,10,5,kg\n'
+                'Import 5,I5,10,5,unknown\n'
+                'Import 6,,10,5,Kilogram\n'
+                'Import 7,I7,10,5,kg,extra\n')
+            created, errors = import_csv(csv_file, batch_size=2,
+                commit=False)
+            self.assertEqual(created, 2)
+            self.assertEqual([line for line, _ in errors], [3, 4, 5, 6, 8])
+            self.assertEqual(errors[-1][1], 'Too many columns')
+            templates = self.template.search([
+                    ('name', 'like', 'Import %'),
+                    ], order=[('name', 'ASC')])
+            self.assertEqual([t.code for t in templates], ['I1', None])
+            self.assertTrue(all(t.unique_variant for t in templates))
+            self.assertEqual([len(t.products) for t in templates], [1, 1])
+            self.assertEqual(templates[0].list_price, Decimal(10))
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            csv_file = StringIO('name,code,default_uom,type\n'
+                'Commit 1,K1,kg,goods\n'
+                'Commit 2,K2,kg,foo\n'
+                'Commit 3,,kg,service\n'
+                'Commit 4,K4,kg,\n')
+            try:
+                created, errors = import_csv(csv_file, batch_size=2)
+                self.assertEqual(created, 3)
+                self.assertEqual([line for line, _ in errors], [3])
+                self.assertIn('"foo"', errors[0][1])
+                templates = self.template.search([
+                        ('name', 'like', 'Commit %'),
+                        ], order=[('name', 'ASC')])
+                self.assertEqual([t.code for t in templates],
+                    ['K1', None, 'K4'])
+                self.assertEqual([len(t.products) for t in templates],
+                    [1, 1, 1])
+            finally:
+                templates = self.template.search([
+                        ('name', 'like', 'Commit %'),
+                        ])
+                self.product.delete([p for t in templates
+                        for p in t.products])
+                self.template.delete(templates)
+                Transaction().cursor.commit()
+
+    def test0100_instrument(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            values = {
+                'name': 'Test instrument',
+                'type': 'goods',
+                'list_price': Decimal(1),
+                'cost_price': Decimal(0),
+                'cost_price_method': 'fixed',
+                'default_uom': kg.id,
+                'unique_variant': True,
+                'code': 'INS1',
+                }
+            self.template.create([values])
+            self.assertEqual(instrument.transaction_counters(), {})
+
+            with Transaction().set_context(
+                    product_variant_unique_instrument=True):
+                template, = self.template.create([dict(values,
+                            code='INS2')])
+                self.template.search([('code', '=', 'INS2')])
+                self.template.read([template.id], ['code'])
+            counters = instrument.transaction_counters()
+            for name in ['template.create', 'template.set_codes',
+                    'template.get_code', 'product.create']:
+                self.assertGreaterEqual(counters[name]['calls'], 1)
+                self.assertGreaterEqual(counters[name]['queries'], 1)
+            self.assertGreaterEqual(
+                counters['template.search_domain']['calls'], 1)
+            self.assertGreaterEqual(counters['template.create']['queries'],
+                counters['template.set_codes']['queries'])
+            self.assertGreaterEqual(
+                instrument.counters()['template.create']['calls'], 1)
+
+    def test0110_default_unique_variant_cache(self):
+        Configuration = POOL.get('product.configuration')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            values = {
+                'type': 'goods',
+                'list_price': Decimal(1),
+                'cost_price': Decimal(0),
+                'cost_price_method': 'fixed',
+                'default_uom': kg.id,
+                }
+            calls = []
+            get_singleton = Configuration.get_singleton
+
+            @classmethod
+            def counted_get_singleton(cls):
+                calls.append(1)
+                return get_singleton()
+            Configuration._unique_variant_cache.clear()
+            Configuration.get_singleton = counted_get_singleton
+            try:
+                templates = self.template.create([dict(values,
+                            name='Test default %s' % i)
+                        for i in range(20)])
+                self.assertEqual(len(calls), 1)
+                self.assertFalse(any(t.unique_variant for t in templates))
+
+                Configuration.create([{
+                            'unique_variant': True,
+                            }])
+                del calls[:]
+                templates = self.template.create([dict(values,
+                            name='Test default unique %s' % i)
+                        for i in range(20)])
+                self.assertEqual(len(calls), 1)
+                self.assertTrue(all(t.unique_variant for t in templates))
+            finally:
+                del Configuration.get_singleton
+            self.assertEqual(Configuration.get_singleton, get_singleton)
+
+    def test0120_search_code_prefix(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            templates = self.template.create([{
+                        'name': 'Test prefix %s' % code,
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'unique_variant': True,
+                        'code': code,
+                        } for code in ['129', '12', '1239', '123', '13',
+                        'AB1', 'ab2']])
+            by_code = dict((t.code, t) for t in templates)
+
+            def search(clause):
+                return sorted(t.code for t in self.template.search([
+                            ('id', 'in', [t.id for t in templates]),
+                            clause,
+                            ]))
+            self.assertEqual(search(('code', 'like', '123%')),
+                ['123', '1239'])
+            self.assertEqual(search(('code', 'ilike', '12%')),
+                ['12', '123', '1239', '129'])
+            self.assertEqual(search(('rec_name', 'ilike', '12%')),
+                ['12', '123', '1239', '129'])
+            self.assertEqual(search(('code', 'ilike', '%23%')),
+                ['123', '1239'])
+            self.assertEqual(search(('code', 'ilike', 'ab%')),
+                ['AB1', 'ab2'])
+            self.assertEqual(search(('code', 'not ilike', '12%')),
+                ['13', 'AB1', 'ab2'])
+
+            self.template.write([by_code['1239']], {'active': False})
+            self.assertEqual(sorted(t.code for t in self.template.search([
+                            ('code', 'like', '123%'),
+                            ('active', '=', False),
+                            ])), ['1239'])
+
+    def test0130_prefetch_products(self):
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            templates = self.template.create([{
+                        'name': 'Test prefetch %s' % i,
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'products': [('create', [{
+                                        'code': '%s-%s' % (i, j),
+                                        } for j in range(i)])],
+                        } for i in range(4)])
+            product = templates[3].products[0]
+            self.product.write([product], {'active': False})
+            ids = [t.id for t in templates]
+
+            def read_products(templates):
+                products, queries, executed = [], [], []
+                cursor = Transaction().cursor
+                execute = cursor.execute
+
+                def counted_execute(*args, **kwargs):
+                    executed.append(args)
+                    return execute(*args, **kwargs)
+                cursor.execute = counted_execute
+                try:
+                    for template in templates:
+                        start = len(executed)
+                        products.append([p.id for p in template.products])
+                        queries.extend(executed[start:])
+                    return products, queries
+                finally:
+                    del cursor.execute
+
+            expected, _ = read_products(self.template.browse(ids))
+            templates = self.template.prefetch_products(
+                self.template.browse(ids))
+            products, queries = read_products(templates)
+            self.assertEqual(products, expected)
+            self.assertEqual(queries, [])
+            self.assertNotIn(product.id, products[3])
+
+            with Transaction().set_context(active_test=False):
+                expected, _ = read_products(self.template.browse(ids))
+                templates = self.template.prefetch_products(
+                    self.template.browse(ids))
+                products, queries = read_products(templates)
+            self.assertEqual(products, expected)
+            self.assertEqual(queries, [])
+            self.assertEqual(sorted(products[3])[0], product.id)
+
+            templates = self.template.browse(ids)
+            prefetched = self.template.prefetch_products(templates, count=2)
+            self.assertEqual([t.id for t in islice(prefetched, 2)], ids[:2])
+            self.assertNotIn('products',
+                templates[2]._local_cache.get(ids[2], {}))
+            self.assertEqual([t.id for t in prefetched], ids[2:])
+
+    def test0140_stock_wizards(self):
+        trytond.tests.test_tryton.install_module('stock')
+        ByLocation = POOL.get('product.by_location', type='wizard')
+        ByWarehouse = POOL.get('stock.product_quantities_warehouse',
+            type='wizard')
+        Location = POOL.get('stock.location')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            warehouse, = Location.search([('type', '=', 'warehouse')])
+            uniq1, uniq2, template1, template2 = self.template.create([{
+                        'name': 'Test wizard %s' % i,
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(0),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'unique_variant': i < 2,
+                        'products': [('create', [{
+                                        'code': 'W%s' % i,
+                                        }])],
+                        } for i in range(4)])
+            product1, = uniq1.products
+            product2, = uniq2.products
+
+            def run(Wizard, state, template_ids):
+                session_id, _, _ = Wizard.create()
+                wizard = Wizard(session_id)
+                with Transaction().set_context(
+                        active_model='product.template',
+                        active_id=template_ids[0],
+                        active_ids=template_ids):
+                    wizard.default_start(None)
+                    wizard.start.forecast_date = None
+                    wizard.start.warehouse = warehouse
+                    action = getattr(Wizard, state).get_action()
+                    action, _ = getattr(wizard, 'do_%s' % state)(action)
+                return action
+
+            for Wizard, state in [(ByLocation, 'open'),
+                    (ByWarehouse, 'open_')]:
+                action = run(Wizard, state, [uniq1.id])
+                self.assertEqual(
+                    PYSONDecoder().decode(action['pyson_context'])['product'],
+                    product1.id)
+
+                action = run(Wizard, state, [uniq1.id, uniq2.id])
+                self.assertEqual(action['res_model'], 'product.product')
+                self.assertEqual(
+                    PYSONDecoder().decode(action['pyson_domain']),
+                    [['id', 'in', [product1.id, product2.id]]])
+                locations = PYSONDecoder().decode(
+                    action['pyson_context'])['locations']
+                self.assertIn(warehouse.id, locations)
+
+                with self.assertRaises(UserError) as cm:
+                    run(Wizard, state,
+                        [uniq1.id, template1.id, uniq2.id, template2.id])
+                self.assertIn('"%s", "%s"' % (template1.rec_name,
+                        template2.rec_name), cm.exception.message)
+                self.assertNotIn(uniq1.rec_name, cm.exception.message)
+
+    def test0150_stock_quantities(self):
+        trytond.tests.test_tryton.install_module('stock')
+        Location = POOL.get('stock.location')
+        Move = POOL.get('stock.move')
+        Currency = POOL.get('currency.currency')
+        Party = POOL.get('party.party')
+        Company = POOL.get('company.company')
+        User = POOL.get('res.user')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            currency, = Currency.create([{
+                        'name': 'Euro',
+                        'code': 'EUR',
+                        'symbol': 'EUR',
+                        }])
+            party, = Party.create([{
+                        'name': 'Test company',
+                        }])
+            company, = Company.create([{
+                        'party': party.id,
+                        'currency': currency.id,
+                        }])
+            User.write([User(USER)], {
+                    'main_company': company.id,
+                    'company': company.id,
+                    })
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            template, uniq_template, empty_template = self.template.create([{
+                        'name': 'Test quantity %s' % i,
+                        'type': 'goods',
+                        'list_price': Decimal(1),
+                        'cost_price': Decimal(2),
+                        'cost_price_method': 'fixed',
+                        'default_uom': kg.id,
+                        'unique_variant': i == 1,
+                        'products': [('create', [{
+                                        'code': 'Q%s-%s' % (i, j),
+                                        } for j in range(products)])],
+                        } for i, products in enumerate([3, 1, 0])])
+            products = template.products + uniq_template.products
+            moves = Move.create([{
+                        'product': product.id,
+                        'uom': kg.id,
+                        'quantity': quantity,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'company': company.id,
+                        'unit_price': Decimal(1),
+                        'currency': currency.id,
+                        } for product, quantity in zip(products,
+                        [5, 3, 7, 4])])
+            Move.do(moves)
+            inactive = products[2]
+            self.product.write([inactive], {'active': False})
+
+            self.assertEqual(self.template.quantity.getter,
+                'get_product_sum')
+            ids = [template.id, uniq_template.id, empty_template.id]
+            for active_test in [True, False]:
+                with Transaction().set_context(locations=[storage.id],
+                        active_test=active_test):
+                    templates = self.template.browse(ids)
+                    products = self.product.search([
+                            ('template', 'in', ids),
+                            ])
+                    if active_test:
+                        self.assertNotIn(inactive, products)
+                    else:
+                        self.assertIn(inactive, products)
+                    for fname in ['quantity', 'forecast_quantity',
+                            'cost_value']:
+                        for record in templates:
+                            self.assertEqual(getattr(record, fname),
+                                sum(getattr(p, fname) for p in products
+                                    if p.template == record))
+                self.assertEqual([t.quantity for t in templates],
+                    [15 if not active_test else 8, 4, 0])
+
+    def test0160_concurrent_variant_creation(self):
+        if backend.name() != 'postgresql':
+            self.skipTest('Only PostgreSQL locks the templates')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            kg, = self.uom.search([('name', '=', 'Kilogram')])
+            template_ids = [t.id for t in self.template.create([{
+                            'name': 'Test concurrent %s' % i,
+                            'type': 'goods',
+                            'list_price': Decimal(1),
+                            'cost_price': Decimal(0),
+                            'cost_price_method': 'fixed',
+                            'default_uom': kg.id,
+                            'unique_variant': True,
+                            } for i in range(20)])]
+            transaction.cursor.commit()
+
+        start = threading.Event()
+        errors = []
+
+        def set_codes(ids, code):
+            with Transaction().start(DB_NAME, USER,
+                    context=CONTEXT) as transaction:
+                start.wait()
+                for _ in range(20):
+                    try:
+                        self.template.set_codes(dict((template_id, code)
+                                for template_id in ids))
+                        transaction.cursor.commit()
+                        break
+                    except DatabaseOperationalError:
+                        # The lock turns the concurrent creation of the
+                        # variant into a serialization failure
+                        transaction.cursor.rollback()
+                    except UserError as exception:
+                        transaction.cursor.rollback()
+                        errors.append(exception.message)
+                        break
+                else:
+                    errors.append('Too many retries')
+
+        threads = []
+        for i in range(4):
+            ids = template_ids[:]
+            random.Random(i).shuffle(ids)
+            threads.append(threading.Thread(target=set_codes,
+                    args=(ids, 'C%s' % i)))
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            products = self.product.search([
+                    ('template', 'in', template_ids),
+                    ])
+            try:
+                self.assertEqual(errors, [])
+                self.assertEqual(sorted(p.template.id for p in products),
+                    sorted(template_ids))
+            finally:
+                self.product.delete(products)
+                self.template.delete(self.template.browse(template_ids))
+                transaction.cursor.commit()
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()